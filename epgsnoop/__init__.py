@@ -1,4 +1,4 @@
 # By hads <epgsnoop@nice.net.nz>
 # Released under the MIT license
 
-__all__ = ['base', 'channels', 'snooper', 'processors', 'outputters', 'tuner']
+__all__ = ['base', 'channels', 'snooper', 'processors', 'outputters', 'tuner', 'spool', 'pipeline', 'cache', 'imdb', 'destinations', 'timeline', 'ringbuffer', 'state', 'changes', 'merge']
@@ -9,6 +9,7 @@ import sys
 import time
 import logging
 import re
+import unicodedata
 
 from datetime import tzinfo, datetime, timedelta
 
@@ -19,6 +20,18 @@ URL = 'http://launchpad.net/epgsnoop'
 log = logging.getLogger(NAME)
 logging.basicConfig(level=logging.INFO, format='%(message)s')
 
+non_word_regex = re.compile(r'\W+', re.UNICODE)
+
+def normalise_title(title):
+    """
+    Reduce a title to lower case words separated by single spaces with
+    accents and punctuation removed, for matching titles between sources.
+    """
+    title = unicodedata.normalize('NFKD', title)
+    title = u''.join([c for c in title if not unicodedata.combining(c)])
+    title = title.lower().replace(u'&', u' and ')
+    return u' '.join(non_word_regex.sub(u' ', title).split())
+
 class StatusDisplay(object):
     def __init__(self):
         self.length = 0
@@ -41,6 +54,17 @@ class Channel(object):
     def __init__(self, pid):
         self.pid = pid
 
+    # Programs read back from a ProgramSpool have their own copy of the
+    # channel, so compare by pid rather than identity
+    def __eq__(self, other):
+        return isinstance(other, Channel) and self.pid == other.pid
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pid)
+
 class Program(dict):
     def __str__(self):
         if 'title' in self and self['title']:
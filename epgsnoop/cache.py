@@ -0,0 +1,113 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import sys
+import time
+import inspect
+import cPickle as pickle
+from hashlib import sha1
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+def signature(processors, config):
+    """
+    Fingerprint a run of processors from their source code and their
+    configuration so cached results are dropped when either changes.
+    The whole module defining each processor is used, so that changes to
+    the helpers and patterns processors share count too.
+    """
+    h = sha1('%s/%s' % (NAME, VERSION))
+    modules = set()
+    for processor in processors:
+        cls = processor.__class__
+        h.update(cls.__name__)
+        if cls.__module__ not in modules:
+            modules.add(cls.__module__)
+            try:
+                h.update(inspect.getsource(sys.modules[cls.__module__]))
+            except (IOError, TypeError, KeyError):
+                pass
+        if config.has_section(cls.__name__):
+            h.update(repr(sorted(config.items(cls.__name__, raw=True))))
+    return h.hexdigest()
+
+class ProcessorCache(object):
+    """
+    Content-addressed cache of the fields processors derive from a
+    program's title and description.
+
+    Entries are kept in memory for the run and, if a database is given,
+    stored in sqlite between runs. Only the `max_entries` most recently
+    used entries are kept in the database.
+    """
+
+    def __init__(self, database=None, max_entries=100000):
+        self.entries = {}
+        self.new = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        self.max_entries = max_entries
+        self.db = None
+        if database:
+            try:
+                try:
+                    from sqlite3 import dbapi2 as sqlite
+                except ImportError:
+                    from pysqlite2 import dbapi2 as sqlite
+            except ImportError:
+                log.info('Not persisting processor cache - sqlite not found.')
+            else:
+                self.sqlite = sqlite
+                # Created here but used from the pipeline thread
+                self.db = sqlite.connect(database, check_same_thread=False)
+                self.db.execute("""CREATE TABLE IF NOT EXISTS cache(
+                    key VARCHAR PRIMARY KEY,
+                    fields BLOB,
+                    used INTEGER
+                    )"""
+                )
+
+    def key(self, signature, program):
+        h = sha1(signature)
+        h.update('\0' + program['title'].encode('utf-8'))
+        if 'description' in program:
+            h.update('\0' + program['description'].encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        fields = self.entries.get(key)
+        if fields is None and self.db is not None:
+            row = self.db.execute('SELECT fields FROM cache WHERE key = ?', (key,)).fetchone()
+            if row:
+                fields = self.entries[key] = pickle.loads(str(row[0]))
+        if fields is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used.add(key)
+        return fields
+
+    def put(self, key, fields):
+        self.entries[key] = self.new[key] = fields
+
+    def close(self):
+        total = self.hits + self.misses
+        if total:
+            log.info('Processor cache: %s hits, %s misses (%.1f%% hit rate)',
+                self.hits, self.misses, 100.0 * self.hits / total)
+        if self.db is None:
+            return
+        now = int(time.time())
+        self.db.executemany('INSERT OR REPLACE INTO cache (key, fields, used) VALUES (?, ?, ?)',
+            [(key, self.sqlite.Binary(pickle.dumps(fields, pickle.HIGHEST_PROTOCOL)), now)
+                for (key, fields) in self.new.iteritems()])
+        self.db.executemany('UPDATE cache SET used = ? WHERE key = ?',
+            [(now, key) for key in self.used])
+        self.db.execute('DELETE FROM cache WHERE key IN '
+            '(SELECT key FROM cache ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+        self.db.commit()
+        self.db.close()
+        self.db = None
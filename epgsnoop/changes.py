@@ -0,0 +1,118 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import socket
+from hashlib import sha1
+from datetime import datetime, timedelta
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+def program_fields(program):
+    """
+    The fields of a program as values JSON can represent, times as ISO
+    8601 and durations in seconds.
+    """
+    fields = {}
+    for (name, value) in program.items():
+        if name in ('channel', 'pid', 'event_id'):
+            continue
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, timedelta):
+            value = value.days * 86400 + value.seconds
+        fields[name] = value
+    return fields
+
+def field_digests(fields):
+    """
+    A compact stand in for the fields of a program, a short digest of
+    each value by name, to compare programs with.
+    """
+    return dict([(name, sha1(repr(value)).digest()[:8]) for (name, value) in fields.iteritems()])
+
+def diff_programs(previous, current, now=None):
+    """
+    Compare programs by service and event id, yielding a change for each
+    program added, changed or removed since previous. Programs from
+    previous which have finished by now are not reported as removed, nor
+    are those of services with no programs in current, which may just not
+    have been captured this time.
+
+    Only digests of the fields of previous are kept, so previous can be
+    read a program at a time, e.g. with state.iter_programs().
+    """
+    if now is None:
+        now = datetime.now(utc)
+    old = {}
+    for program in previous:
+        if 'event_id' in program:
+            old[(program['pid'], program['event_id'])] = (program['end'], program['channel'].xmltvid,
+                field_digests(program_fields(program)))
+    services = set()
+    for program in current:
+        services.add(program['pid'])
+        if 'event_id' not in program:
+            continue
+        key = (program['pid'], program['event_id'])
+        change = {
+            'service': int(program['pid']),
+            'event': program['event_id'],
+            'channel': program['channel'].xmltvid,
+        }
+        fields = program_fields(program)
+        if key not in old:
+            change['change'] = 'added'
+            change['fields'] = fields
+            yield change
+            continue
+        before = old.pop(key)[2]
+        digests = field_digests(fields)
+        changed = dict([(name, fields[name]) for (name, digest) in digests.items() if before.get(name) != digest])
+        for name in before:
+            if name not in fields:
+                changed[name] = None
+        if changed:
+            change['change'] = 'changed'
+            change['fields'] = changed
+            yield change
+    for ((pid, event_id), (end, channel, before)) in old.items():
+        if pid in services and end > now:
+            yield {
+                'change': 'removed',
+                'service': int(pid),
+                'event': event_id,
+                'channel': channel,
+            }
+
+class ChangeFeed(object):
+    """
+    Writes changes as JSON Lines, appended to a file or sent to the Unix
+    socket at PATH if given as unix:PATH.
+    """
+    def __init__(self, destination):
+        self.destination = destination
+        if destination.startswith('unix:'):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(destination[5:])
+            self.file = self.socket.makefile('wb')
+        else:
+            self.socket = None
+            self.file = open(destination, 'ab')
+        self.counts = {'added': 0, 'changed': 0, 'removed': 0}
+
+    def write(self, change):
+        self.counts[change['change']] += 1
+        self.file.write(json.dumps(change, sort_keys=True, separators=(',', ':'), default=unicode) + '\n')
+
+    def close(self):
+        self.file.close()
+        if self.socket:
+            self.socket.close()
+        log.info('Changes: %(added)s added, %(changed)s changed, %(removed)s removed', self.counts)
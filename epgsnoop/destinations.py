@@ -0,0 +1,138 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import os
+import sys
+import gzip
+import tempfile
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+class DestinationError(Exception):
+    pass
+
+class AtomicFile(object):
+    """
+    Writes to a temporary file alongside `path` which is renamed into place
+    by close(), so readers never see a partly written file.
+    """
+    def __init__(self, path):
+        self.path = path
+        (directory, name) = os.path.split(os.path.abspath(path))
+        (fd, self.tmp) = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        # mkstemp creates files only the owner can read
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmp, 0666 & ~umask)
+        os.rename(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+class Stdout(object):
+    def write(self, data):
+        sys.stdout.write(data)
+
+    def flush(self):
+        sys.stdout.flush()
+
+    def close(self):
+        sys.stdout.flush()
+
+    def abort(self):
+        pass
+
+class Tee(object):
+    def __init__(self, files):
+        self.files = files
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+
+    def flush(self):
+        for f in self.files:
+            f.flush()
+
+class XzStream(object):
+    def __init__(self, fileobj):
+        try:
+            try:
+                import lzma
+            except ImportError:
+                from backports import lzma
+        except ImportError:
+            raise DestinationError('xz compression requires the lzma module')
+        self.fileobj = fileobj
+        self.compressor = lzma.LZMACompressor()
+
+    def write(self, data):
+        self.fileobj.write(self.compressor.compress(data))
+
+    def close(self):
+        self.fileobj.write(self.compressor.flush())
+
+class Destinations(object):
+    """
+    Writes the same output to several files in a single pass. Files ending
+    in .gz or .xz are compressed as they are written, each kind of
+    compression is only done once however many files use it. A path of -
+    writes uncompressed output to stdout.
+    """
+    def __init__(self, paths):
+        self.files = []
+        self.streams = []
+        groups = {}
+        try:
+            for path in paths:
+                if path == '-':
+                    f = Stdout()
+                else:
+                    f = AtomicFile(path)
+                self.files.append(f)
+                groups.setdefault(os.path.splitext(path)[1], []).append(f)
+            for (extension, files) in groups.iteritems():
+                tee = Tee(files)
+                if extension == '.gz':
+                    self.streams.append(gzip.GzipFile(mode='wb', fileobj=tee))
+                elif extension == '.xz':
+                    self.streams.append(XzStream(tee))
+                else:
+                    self.streams.append(tee)
+        except (IOError, OSError), e:
+            self.abort()
+            raise DestinationError('Unable to write to %s: %s' % (path, e))
+        except DestinationError:
+            self.abort()
+            raise
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+    def close(self):
+        for stream in self.streams:
+            if not isinstance(stream, Tee):
+                stream.close()
+        for f in self.files:
+            f.close()
+
+    def abort(self):
+        for f in self.files:
+            f.abort()
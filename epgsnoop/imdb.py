@@ -0,0 +1,107 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+# Builds the local title index used by the Imdb processor from the IMDb
+# datasets at http://www.imdb.com/interfaces/ (title.basics.tsv.gz and
+# title.ratings.tsv.gz).
+
+import os
+import gzip
+import time
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+# Title types worth matching against broadcast programs
+TITLE_TYPES = ('movie', 'tvMovie', 'tvSeries', 'tvMiniSeries')
+
+def connect(database):
+    try:
+        from sqlite3 import dbapi2 as sqlite
+    except ImportError:
+        from pysqlite2 import dbapi2 as sqlite
+    return sqlite.connect(database, check_same_thread=False)
+
+def read_tsv(filename):
+    if filename.endswith('.gz'):
+        f = gzip.open(filename)
+    else:
+        f = open(filename)
+    try:
+        columns = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            yield dict(zip(columns, [v != '\\N' and v or None for v in fields]))
+    finally:
+        f.close()
+
+def _titles(basics):
+    for row in read_tsv(basics):
+        if row['titleType'] not in TITLE_TYPES or row['isAdult'] == '1':
+            continue
+        year = row['startYear'] and int(row['startYear']) or None
+        runtime = row['runtimeMinutes'] and int(row['runtimeMinutes']) or None
+        titles = [row['primaryTitle']]
+        if row['originalTitle'] and row['originalTitle'] != row['primaryTitle']:
+            titles.append(row['originalTitle'])
+        for title in titles:
+            title = normalise_title(title.decode('utf-8'))
+            if title:
+                yield (title, year, row['tconst'], row['titleType'], runtime)
+
+def _ratings(ratings):
+    for row in read_tsv(ratings):
+        yield (row['tconst'], float(row['averageRating']), int(row['numVotes']))
+
+def build_index(basics, ratings, database):
+    """
+    Build the title index at database from the basics and ratings
+    datasets, replacing any existing index.
+    """
+    started = time.time()
+    tmp = database + '.tmp'
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    db = connect(tmp)
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute("""CREATE TEMPORARY TABLE ratings(
+        tconst VARCHAR PRIMARY KEY,
+        rating REAL,
+        votes INTEGER
+        )"""
+    )
+    db.execute("""CREATE TEMPORARY TABLE basics(
+        title VARCHAR,
+        year INTEGER,
+        tconst VARCHAR,
+        title_type VARCHAR,
+        runtime INTEGER
+        )"""
+    )
+    db.executemany('INSERT INTO ratings VALUES (?, ?, ?)', _ratings(ratings))
+    db.executemany('INSERT INTO basics VALUES (?, ?, ?, ?, ?)', _titles(basics))
+    db.execute("""CREATE TABLE titles(
+        title VARCHAR,
+        year INTEGER,
+        imdb_id VARCHAR,
+        title_type VARCHAR,
+        runtime INTEGER,
+        rating REAL,
+        votes INTEGER
+        )"""
+    )
+    # Ordering by title keeps each title's rows together on disk
+    db.execute("""INSERT INTO titles
+        SELECT b.title, b.year, substr(b.tconst, 3), b.title_type, b.runtime, r.rating, r.votes
+        FROM basics b LEFT JOIN ratings r ON r.tconst = b.tconst
+        ORDER BY b.title, b.year"""
+    )
+    db.execute('CREATE INDEX titles_title_year ON titles(title, year)')
+    db.commit()
+    count = db.execute('SELECT COUNT(*) FROM titles').fetchone()[0]
+    db.close()
+    os.rename(tmp, database)
+    log.info('Indexed %s IMDb titles in %.1f seconds', count, time.time() - started)
+    return count
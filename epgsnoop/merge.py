@@ -0,0 +1,210 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+# Merges the guides from several epgsnoop runs, each an XMLTV file or a
+# saved guide snapshot, into one XMLTV document without reading any of
+# them into memory whole.
+
+import os
+import gzip
+import heapq
+import cPickle as pickle
+from datetime import datetime, timedelta
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from base import *
+from outputters import XMLTV
+
+log = logging.getLogger(NAME)
+
+class MergeError(Exception):
+    pass
+
+def parse_time(value):
+    """
+    Convert an XMLTV time such as '20110531220000 +1200' to a naive UTC
+    datetime.
+    """
+    parsed = datetime.strptime(value[:14], '%Y%m%d%H%M%S')
+    offset = value[14:].strip()
+    if offset:
+        minutes = int(offset[1:3]) * 60 + int(offset[3:5])
+        if offset[0] == '-':
+            minutes = -minutes
+        parsed -= timedelta(minutes=minutes)
+    return parsed
+
+def open_input(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise MergeError('Reading %s requires the lzma module' % path)
+        return lzma.LZMAFile(path, 'rb')
+    return open(path, 'rb')
+
+def is_snapshot(path):
+    f = open_input(path)
+    try:
+        # Snapshots are pickled with protocol 2 or later
+        return f.read(1) == '\x80'
+    finally:
+        f.close()
+
+class XMLTVInput(object):
+    """
+    Reads the channels and then the programmes of an XMLTV file in the
+    order they appear. Freshness is the date of the tv element, or when
+    the file was last modified.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open_input(path)
+        self.events = ElementTree.iterparse(self.file, events=('start', 'end'))
+        self.freshness = datetime.utcfromtimestamp(os.path.getmtime(path))
+        self.first = None
+        self.root = None
+        self.channels = {}
+        for (event, element) in self.events:
+            if event == 'start' and self.root is None:
+                self.root = element
+                date = element.get('date')
+                if date and date[14:].strip():
+                    self.freshness = parse_time(date)
+                elif date:
+                    # Earlier versions wrote the date in local time
+                    # without an offset
+                    self.freshness = parse_time(date).replace(tzinfo=local).astimezone(utc).replace(tzinfo=None)
+            elif event == 'start' and element.tag == 'programme':
+                self.first = element
+                break
+            elif event == 'end' and element.tag == 'channel':
+                self.channels[element.get('id')] = self.serialise(element)
+                self.root.clear()
+
+    def serialise(self, element):
+        element.tail = None
+        # In the encoding of XMLTV.header(), anything outside it as a
+        # character reference
+        text = ElementTree.tostring(element, 'utf-8').decode('utf-8')
+        return text.encode('latin-1', 'xmlcharrefreplace')
+
+    def programmes(self):
+        if self.first is None:
+            return
+        for (event, element) in self.events:
+            if event == 'end' and element.tag == 'programme':
+                yield (element.get('channel'), parse_time(element.get('start')),
+                    parse_time(element.get('stop') or element.get('start')), self.serialise(element))
+                self.root.clear()
+        self.file.close()
+
+class SnapshotInput(object):
+    """
+    Reads the programs of a guide snapshot, rendering them as XMLTV.
+    Freshness is when the snapshot was saved.
+    """
+    def __init__(self, path, config):
+        self.path = path
+        self.outputter = XMLTV(config)
+        self.freshness = datetime.utcfromtimestamp(os.path.getmtime(path))
+        # Snapshots don't hold channels apart from the programs, finding
+        # them takes a pass over the programs
+        self.channels = {}
+        for program in self.programs():
+            channel = program['channel']
+            if channel.xmltvid not in self.channels:
+                self.channels[channel.xmltvid] = self.outputter.channel(channel)
+
+    def programs(self):
+        f = open_input(self.path)
+        try:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    break
+        finally:
+            f.close()
+
+    def programmes(self):
+        for program in self.programs():
+            yield (program['channel'].xmltvid, program['start'].astimezone(utc).replace(tzinfo=None),
+                program['end'].astimezone(utc).replace(tzinfo=None), self.outputter.program(program))
+
+def ordered(source, rank):
+    """
+    Tag the programmes of an input with its freshness rank, checking they
+    are in channel and start time order as a merge needs.
+    """
+    last = None
+    for (channel, start, stop, text) in source.programmes():
+        if last is not None and (channel, start) < last:
+            raise MergeError('%s is not in channel and start time order' % source.path)
+        last = (channel, start)
+        yield (channel, start, rank, stop, text)
+
+def merge(paths, config, stream):
+    """
+    Merge the guides at paths into one XMLTV document written to stream.
+    Channels and programmes found in more than one guide are taken from
+    the freshest, as are programmes which overlap a programme from
+    another guide.
+    """
+    sources = []
+    for path in paths:
+        if is_snapshot(path):
+            sources.append(SnapshotInput(path, config))
+        else:
+            sources.append(XMLTVInput(path))
+    # Rank 0 is the freshest
+    sources.sort(key=lambda source: source.freshness, reverse=True)
+    for source in sources:
+        log.info('%s: %s channels, from %s', source.path, len(source.channels), source.freshness)
+
+    outputter = XMLTV(config)
+    stream.write(outputter.header() + '\n')
+    channels = {}
+    for source in reversed(sources):
+        channels.update(source.channels)
+    for channel in sorted(channels):
+        stream.write(channels[channel] + '\n')
+
+    written = dropped = 0
+    pending = None
+    for programme in heapq.merge(*[ordered(source, rank) for (rank, source) in enumerate(sources)]):
+        (channel, start, rank, stop, text) = programme
+        if pending is not None and pending[0] == channel and (start < pending[3] or start == pending[1]):
+            # The same programme, or one overlapping it, from another
+            # guide. Keep the one from the fresher guide, overlaps within
+            # a guide are left as they are.
+            if rank < pending[2]:
+                pending = programme
+            elif rank == pending[2]:
+                stream.write(pending[4] + '\n')
+                written += 1
+                pending = programme
+                continue
+            dropped += 1
+            continue
+        if pending is not None:
+            stream.write(pending[4] + '\n')
+            written += 1
+        pending = programme
+    if pending is not None:
+        stream.write(pending[4] + '\n')
+        written += 1
+    stream.write(outputter.footer())
+    log.info('Merged %s programmes from %s guides, dropping %s duplicates and overlaps',
+        written, len(sources), dropped)
+    return written
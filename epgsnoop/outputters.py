@@ -2,40 +2,311 @@
 # Released under the MIT license
 
 import os
+import time
 import logging
+import tempfile
 import ConfigParser
+import cPickle as pickle
+from hashlib import sha1
+from StringIO import StringIO
 
 from datetime import datetime, timedelta
 from cgi import escape
 
 from base import *
+from timeline import Timeline, channel_order
 
 log = logging.getLogger(NAME)
 
+class FragmentCache(object):
+    """
+    Keeps the rendered programmes for each channel and day on disk with a
+    hash of the programs they were rendered from, so that only fragments
+    whose programs have changed need to be rendered again.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = os.path.join(directory, 'index.pickle')
+        try:
+            f = open(self.index, 'rb')
+            try:
+                self.hashes = pickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            self.hashes = {}
+        self.previous = dict(self.hashes)
+
+    def path(self, key):
+        return os.path.join(self.directory, '%s.xml' % sha1(repr(key)).hexdigest())
+
+    def has(self, key, digest):
+        return self.hashes.get(key) == digest and os.path.exists(self.path(key))
+
+    def read(self, key):
+        f = open(self.path(key), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def write(self, key, digest, fragment):
+        path = self.path(key)
+        f = open(path + '.tmp', 'wb')
+        try:
+            f.write(fragment)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+        self.hashes[key] = digest
+
+    def save(self, digests):
+        """
+        Forget fragments not in digests and store the index. Returns the
+        keys which are new, changed or gone since the last save.
+        """
+        changed = set()
+        for key in self.hashes.keys():
+            if key not in digests:
+                changed.add(key)
+                del self.hashes[key]
+                if os.path.exists(self.path(key)):
+                    os.remove(self.path(key))
+        for (key, digest) in digests.iteritems():
+            if self.previous.get(key) != digest:
+                changed.add(key)
+        f = open(self.index + '.tmp', 'wb')
+        try:
+            pickle.dump(self.hashes, f, pickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(self.index + '.tmp', self.index)
+        return changed
+
+class Writer(object):
+    """
+    Writes the pieces of an outputter's output to a stream separated by
+    newlines, leaving out empty pieces.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.first = True
+
+    def write(self, output):
+        if output:
+            if not self.first:
+                self.stream.write('\n')
+            self.stream.write(output)
+            self.first = False
+
+class ChannelSpool(object):
+    """
+    Keeps an outputter's programmes in a temporary file a channel at a
+    time, so they can be written out afterwards in another channel order.
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(prefix='%s-' % NAME)
+        self.chunks = {}
+
+    def write(self, pid, output):
+        if output:
+            if pid in self.chunks:
+                self.file.write('\n')
+                start = self.chunks[pid][0]
+            else:
+                start = self.file.tell()
+            self.file.write(output)
+            self.chunks[pid] = (start, self.file.tell())
+
+    def copy(self, pid, writer):
+        if pid in self.chunks:
+            (start, end) = self.chunks[pid]
+            self.file.seek(start)
+            writer.write(self.file.read(end - start))
+
+    def close(self):
+        self.file.close()
+
+def write_outputs(outputs, channels, programs):
+    """
+    Write the output of several outputters in a single pass over the
+    programs. outputs is a list of (outputter, stream) pairs. Work which
+    outputters with the same shareKey() have in common is done once per
+    program by prepare(). Each outputter writes its channels and their
+    programmes in the order of its channelOrder(), the programmes of
+    outputters which order channels differently from the first are
+    spooled and written once the pass is done.
+    """
+    if not isinstance(programs, Timeline):
+        programs = Timeline(programs)
+    outputs = [(outputter, Writer(stream)) for (outputter, stream) in outputs]
+    orders = {}
+    for (outputter, writer) in outputs:
+        orders[outputter] = tuple([channel.pid for channel in sorted(channels.values(), key=outputter.channelOrder)
+            if channel.pid in programs.channels])
+
+    for (outputter, writer) in outputs:
+        outputter.channels = channels
+        writer.write(outputter.header())
+        for pid in orders[outputter]:
+            writer.write(outputter.channel(channels[pid]))
+
+    plain = [(o, w) for (o, w) in outputs if o.fragments is None]
+    if plain:
+        order = orders[plain[0][0]]
+        spools = dict([(o, ChannelSpool()) for (o, w) in plain if orders[o] != order])
+        try:
+            for pid in order:
+                for program in programs.channel(pid):
+                    if not program.isValid():
+                        continue
+                    prepared = {}
+                    for (outputter, writer) in plain:
+                        key = outputter.shareKey()
+                        if key not in prepared:
+                            prepared[key] = outputter.prepare(program)
+                        if outputter in spools:
+                            spools[outputter].write(pid, outputter.program(program, prepared[key]))
+                        else:
+                            writer.write(outputter.program(program, prepared[key]))
+            for (outputter, writer) in plain:
+                if outputter in spools:
+                    for pid in orders[outputter]:
+                        spools[outputter].copy(pid, writer)
+        finally:
+            for spool in spools.values():
+                spool.close()
+    fragmented = [(o, w) for (o, w) in outputs if o.fragments is not None]
+    if fragmented:
+        write_fragments(fragmented, channels, programs, orders)
+
+    for (outputter, writer) in outputs:
+        writer.write(outputter.footer())
+
+def write_fragments(outputs, channels, programs, orders):
+    """
+    Write the programmes for each channel and day from the outputters'
+    FragmentCaches, only rendering those channels and days whose programs
+    have changed since the last run. orders gives each outputter's
+    channels in the order they're written.
+    """
+    digests = dict([(outputter, {}) for (outputter, writer) in outputs])
+    for program in programs:
+        if program.isValid():
+            key = outputs[0][0].fragmentKey(program)
+            fingerprint = outputs[0][0].fingerprint(program)
+            for (outputter, writer) in outputs:
+                if key not in digests[outputter]:
+                    digests[outputter][key] = sha1(outputter.fragmentSalt())
+                digests[outputter][key].update(fingerprint)
+    stale = {}
+    for (outputter, writer) in outputs:
+        for key in digests[outputter]:
+            digests[outputter][key] = digests[outputter][key].hexdigest()
+        stale[outputter] = set([key for (key, digest) in digests[outputter].iteritems()
+            if not outputter.fragments.has(key, digest)])
+
+    if [s for s in stale.values() if s]:
+        # A timeline gives each channel's programs in start time order, so
+        # the programs for a fragment come together and each fragment can
+        # be written as soon as the next one starts
+        rendered = dict([(outputter, []) for (outputter, writer) in outputs])
+        current = None
+        for program in programs:
+            if program.isValid():
+                key = outputs[0][0].fragmentKey(program)
+                if key != current:
+                    flush_fragments(outputs, current, stale, digests, rendered)
+                    current = key
+                prepared = {}
+                for (outputter, writer) in outputs:
+                    if key in stale[outputter]:
+                        share = outputter.shareKey()
+                        if share not in prepared:
+                            prepared[share] = outputter.prepare(program)
+                        output = outputter.program(program, prepared[share])
+                        if output:
+                            rendered[outputter].append(output)
+        flush_fragments(outputs, current, stale, digests, rendered)
+
+    for (outputter, writer) in outputs:
+        changed = outputter.fragments.save(digests[outputter])
+        outputter.changed_channels = []
+        for pid in set([key[0] for key in changed]):
+            if pid in channels:
+                outputter.changed_channels.append(channels[pid])
+        outputter.reportChanges()
+
+        keys = sorted(digests[outputter].keys())
+        for pid in orders[outputter]:
+            for key in keys:
+                if key[0] == pid:
+                    writer.write(outputter.fragments.read(key))
+
+def flush_fragments(outputs, key, stale, digests, rendered):
+    """
+    Write the programmes rendered for key to the outputters' caches.
+    """
+    for (outputter, writer) in outputs:
+        if key in stale[outputter]:
+            outputter.fragments.write(key, digests[outputter][key], '\n'.join(rendered[outputter]))
+        rendered[outputter] = []
+
 class BaseOutputter(object):
+    # A FragmentCache to render incrementally with
+    fragments = None
+
     def __init__(self, config):
         self.config = config
     
     def __call__(self, channels, programs):
-        self.channels = channels
-        channels_seen = []
-        output = []
-        
-        for program in programs:
-            if program.isValid() and program['channel'].pid not in channels_seen:
-                channels_seen.append(program['channel'].pid)
-        
-        output.append(self.header())
-        for channel in channels.values():
-            if channel.pid in channels_seen:
-                output.append(self.channel(channel))
-        for program in programs:
-            if program.isValid():
-                output.append(self.program(program))
-        output.append(self.footer())
+        stream = StringIO()
+        self.write(stream, channels, programs)
+        return stream.getvalue()
 
-        output = [o for o in output if o]
-        return '\n'.join(output)
+    def write(self, stream, channels, programs):
+        """
+        Write the output to stream piece by piece rather than building
+        the whole document in memory.
+        """
+        write_outputs([(self, stream)], channels, programs)
+
+    def channelOrder(self, channel):
+        """
+        Sort key for the order channels and their programmes are written.
+        """
+        return channel_order(channel)
+
+    def shareKey(self):
+        """
+        Outputters with the same share key get the same result from
+        prepare(), so it only needs calling once for all of them.
+        """
+        return self
+
+    def prepare(self, program):
+        pass
+
+    def fragmentKey(self, program):
+        return (program['channel'].pid, program['start'].astimezone(local).strftime('%Y-%m-%d'))
+
+    def fragmentSalt(self):
+        return '%s/%s %s %s' % (NAME, VERSION, self.__class__.__name__, time.tzname)
+
+    def fingerprint(self, program):
+        fields = []
+        for (name, value) in sorted(program.items()):
+            if isinstance(value, Channel):
+                value = (value.pid, value.xmltvid)
+            elif isinstance(value, datetime):
+                value = value.isoformat()
+            fields.append((name, value))
+        return repr(fields)
+
+    def reportChanges(self):
+        log.info('Changed channels: %s', ', '.join([c.xmltvid or c.pid for c in self.changed_channels]) or 'none')
 
     def header(self):
         pass
@@ -46,23 +317,43 @@ class BaseOutputter(object):
     def channel(self, channel):
         pass
     
-    def program(self, program):
+    def program(self, program, prepared=None):
         pass
 
 class Test(BaseOutputter):
     def channel(self, channel):
         return '%s - %s' % (channel.pid, channel.xmltvid)
     
-    def program(self, program):
+    def program(self, program, prepared=None):
         return '%(title)s - %(start)s (%(duration)s)' % program
 
 class XMLTV(BaseOutputter):
     def __init__(self, config, old_channel_ids=False):
         BaseOutputter.__init__(self, config)
         self.old_channel_ids = old_channel_ids
+        try:
+            directory = os.path.expanduser(config.get('XMLTV', 'fragment_cache'))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+        else:
+            self.fragments = FragmentCache(os.path.join(directory, self.__class__.__name__))
+
+    def reportChanges(self):
+        BaseOutputter.reportChanges(self)
+        # Not shared with subclasses as the channel ids differ
+        try:
+            changes_file = os.path.expanduser(self.config.get(self.__class__.__name__, 'changed_channels'))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return
+        f = open(changes_file, 'w')
+        try:
+            for channel in self.changed_channels:
+                f.write('%s\n' % self.channelId(channel))
+        finally:
+            f.close()
     
     def header(self):
-        gendate = datetime.now().strftime("%Y%m%d%H%M%S %z")
+        gendate = datetime.now(local).strftime("%Y%m%d%H%M%S %z")
         return '<?xml version="1.0" encoding="ISO-8859-1"?>\n'\
             '<!DOCTYPE tv SYSTEM "xmltv.dtd">\n'\
             '<tv generator-info-name="%s/%s" generator-info-url="%s" date="%s">' % (NAME, VERSION, URL, gendate)
@@ -80,10 +371,7 @@ class XMLTV(BaseOutputter):
             icon_url_base = self.config.get('XMLTV', 'icon_url_base')
         except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             show_icons = False
-        if self.old_channel_ids:
-            output.append('<channel id="%s.dvb.guide">' % channel.pid)
-        else:
-            output.append('<channel id="%s">' % channel.xmltvid)
+        output.append('<channel id="%s">' % self.channelId(channel))
         output.append('\t<display-name>%s</display-name>' % channel.name)
         if channel.icon and show_icons:
             output.append('\t<icon src="%s%s" />' % (icon_url_base, channel.icon))
@@ -92,21 +380,37 @@ class XMLTV(BaseOutputter):
         output.append('</channel>')
         return '\n'.join(output)
     
-    def program(self, program):
+    def channelId(self, channel):
+        if self.old_channel_ids:
+            return '%s.dvb.guide' % channel.pid
+        else:
+            return channel.xmltvid
+
+    def channelOrder(self, channel):
+        # In channel id order, which epgsnoop-merge relies on
+        return (self.channelId(channel) or '', channel.pid)
+
+    def shareKey(self):
+        # Everything but the channel id is the same for XMLTV and OldXMLTV
+        return XMLTV
+
+    def program(self, program, prepared=None):
+        if prepared is None:
+            prepared = self.prepare(program)
+        (times, body) = prepared
+        return '<programme channel="%s"%s>'.encode('latin-1', 'replace') \
+            % (self.channelId(program['channel']), times) + '\n' + body
+
+    def prepare(self, program):
+        """
+        Render everything but the channel id of a programme, returning the
+        start and stop attributes and the body of the programme element.
+        """
         output = []
         start = program['start'].astimezone(local)
         end = program['end'].astimezone(local)
-        
-        if self.old_channel_ids:
-            output.append(
-                '<programme channel="%s.dvb.guide" start="%s" stop="%s">' \
-                % (program['channel'].pid, start.strftime("%Y%m%d%H%M%S %z"), end.strftime("%Y%m%d%H%M%S %z"))
-            )
-        else:
-            output.append(
-                '<programme channel="%s" start="%s" stop="%s">' \
-                % (program['channel'].xmltvid, start.strftime("%Y%m%d%H%M%S %z"), end.strftime("%Y%m%d%H%M%S %z"))
-            )
+        times = ' start="%s" stop="%s"' % (start.strftime("%Y%m%d%H%M%S %z"), end.strftime("%Y%m%d%H%M%S %z"))
+
         if 'language' in program:
             output.append('\t<title lang="%s">%s</title>' % (program['language'], escape(program['title'])))
         else:
@@ -170,7 +474,7 @@ class XMLTV(BaseOutputter):
         output.append('</programme>')
 
         output = [o.encode('latin-1','replace') for o in output]
-        return '\n'.join(output)
+        return (times, '\n'.join(output))
 
 class OldXMLTV(XMLTV):
     def __init__(self, config):
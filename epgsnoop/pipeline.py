@@ -0,0 +1,115 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import sys
+import threading
+from Queue import Queue, Empty
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+class Pipeline(threading.Thread):
+    """
+    Runs the per-program processors while the capture is still going.
+
+    The Snooper appends programs to the pipeline as it finds them, they are
+    passed through a bounded queue to a worker thread which sets the
+    program's channel and applies the processors at the start of the chain
+    which have per_program set. The processors from the first whole-set
+    processor onwards are left in `remaining` to be run after the capture.
+    A program replaced by the Snooper replaces the processed program at
+    the same position once it has been through the processors.
+    """
+    # Marks the end of the capture in the queue
+    done = object()
+
+    def __init__(self, channels, loader, programs=None, maxsize=1000):
+        threading.Thread.__init__(self, name='Pipeline')
+        self.setDaemon(True)
+        self.channels = channels
+        self.loader = loader
+        if programs is None:
+            programs = []
+        self.programs = programs
+        self.queue = Queue(maxsize)
+        self.count = 0
+        self.processors = []
+        self.remaining = []
+        self.error = None
+
+    def __len__(self):
+        return self.count
+
+    def append(self, program):
+        self.count += 1
+        self.queue.put(program)
+
+    def __setitem__(self, position, program):
+        self.queue.put((position, program))
+
+    def finish(self):
+        """
+        Wait for all captured programs to be processed and return them.
+        """
+        self.queue.put(self.done)
+        self.join()
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        for processor in self.processors:
+            processor.programs = self.programs
+            processor.postProcess()
+        return self.programs
+
+    def run(self):
+        try:
+            # Hold on to programs until the processors have loaded rather
+            # than blocking the capture on a slow processor setup
+            waiting = []
+            while self.loader.isAlive():
+                try:
+                    program = self.queue.get(timeout=0.1)
+                except Empty:
+                    continue
+                if program is self.done:
+                    self.queue.put(program)
+                    break
+                waiting.append(program)
+            self.split(self.loader.get())
+            for program in waiting:
+                self.process(program)
+            del waiting
+            while True:
+                program = self.queue.get()
+                if program is self.done:
+                    break
+                self.process(program)
+        except:
+            self.error = sys.exc_info()
+            # Keep draining so the capture isn't blocked on a full queue
+            while self.queue.get() is not self.done:
+                pass
+
+    def split(self, processors):
+        for i, processor in enumerate(processors):
+            if not processor.per_program:
+                self.remaining = processors[i:]
+                break
+            if processor.valid:
+                processor.logStart()
+                self.processors.append(processor)
+
+    def process(self, program):
+        position = None
+        if isinstance(program, tuple):
+            (position, program) = program
+        try:
+            program['channel'] = self.channels[program['pid']]
+        except KeyError:
+            log.debug("Ignoring program data for PID '%s' (entry not found in channels.conf)", program['pid'])
+        for processor in self.processors:
+            processor.processOne(program)
+        if position is None:
+            self.programs.append(program)
+        else:
+            self.programs[position] = program
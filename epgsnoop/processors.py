@@ -5,15 +5,78 @@ import os
 import re
 import copy
 import logging
+import threading
 import ConfigParser
 from urllib import urlopen
 
 from base import *
+from spool import modify
+from cache import signature
+from timeline import Timeline
+import imdb
 
 log = logging.getLogger(NAME)
 
+def load_processors(names, config, cache=None):
+    """
+    Construct the named processors. Processors which can't be found or
+    which fail to initialise are logged and left out. If a cache is given
+    each run of cacheable processors is wrapped in CachedProcessors.
+    """
+    processors = []
+    for name in names:
+        processor = globals().get(name)
+        if not (isinstance(processor, type) and issubclass(processor, BaseProcessor)):
+            log.warning("Processor '%s' not found, ignoring.", name)
+            continue
+        try:
+            processors.append(processor(config))
+        except Exception, e:
+            log.warning("Processor '%s' failed to initialise, ignoring: %s", name, e)
+    if cache is None:
+        return processors
+    grouped = []
+    for processor in processors:
+        if not processor.cacheable:
+            grouped.append(processor)
+        elif grouped and isinstance(grouped[-1], CachedProcessors):
+            grouped[-1].processors.append(processor)
+        else:
+            grouped.append(CachedProcessors(config, cache, [processor]))
+    return grouped
+
+class ProcessorLoader(threading.Thread):
+    """
+    Constructs processors in the background so that fetching remote data
+    and opening databases happens while the capture is running.
+    """
+    def __init__(self, names, config, cache=None):
+        threading.Thread.__init__(self, name='ProcessorLoader')
+        self.setDaemon(True)
+        self.names = names
+        self.config = config
+        self.cache = cache
+        self.processors = []
+
+    def run(self):
+        self.processors = load_processors(self.names, self.config, self.cache)
+        log.debug('Processors loaded: %s', ', '.join([p.__class__.__name__ for p in self.processors]))
+
+    def get(self):
+        """
+        Wait for loading to finish and return the processors.
+        """
+        self.join()
+        return self.processors
+
 class BaseProcessor(object):
     valid = True
+    # Whether process() only looks at the program it is given, processors
+    # which look at other programs must set this to False
+    per_program = True
+    # Whether the fields process() sets depend only on the title and
+    # description, so results can be kept in a ProcessorCache
+    cacheable = False
 
     def __init__(self, config):
         self.config = config
@@ -21,37 +84,81 @@ class BaseProcessor(object):
     def __call__(self, programs):
         self.programs = programs
         if self.valid:
-            log.info('Processing programs with %s processor' % self.__class__.__name__)
-            for program in self.programs:
-                if program.isValid():
-                    self.process(program)
-                else:
-                    if 'title' in program:
-                        log.debug(
-                            'Ignoring invalid program (PID:%s) (Title:%s)', program['pid'], program['title']
-                        )
-                        if 'start' not in program:
-                            log.debug('No start')
-                        if 'end' not in program:
-                            log.debug('No end')
-                        if 'channel' not in program:
-                            log.debug('No channel')
-                    else:
-                        log.debug('Ignoring invalid program (no title)')
+            self.logStart()
+            for program in modify(self.programs):
+                self.processOne(program)
             self.postProcess()
         return self.programs
 
+    def logStart(self):
+        log.info('Processing programs with %s processor' % self.__class__.__name__)
+
+    def processOne(self, program):
+        if program.isValid():
+            self.process(program)
+        else:
+            if 'title' in program:
+                log.debug(
+                    'Ignoring invalid program (PID:%s) (Title:%s)', program['pid'], program['title']
+                )
+                if 'start' not in program:
+                    log.debug('No start')
+                if 'end' not in program:
+                    log.debug('No end')
+                if 'channel' not in program:
+                    log.debug('No channel')
+            else:
+                log.debug('Ignoring invalid program (no title)')
+
     def process(self, program):
         raise NotImplementedError
 
     def postProcess(self):
         pass
 
+class CachedProcessors(BaseProcessor):
+    """
+    Applies a run of cacheable processors, reusing the fields they set
+    for any title and description which has been seen before.
+    """
+    def __init__(self, config, cache, processors):
+        BaseProcessor.__init__(self, config)
+        self.cache = cache
+        self.processors = processors
+        self.signature = None
+
+    def logStart(self):
+        for processor in self.processors:
+            processor.logStart()
+
+    def process(self, program):
+        if self.signature is None:
+            self.signature = signature(self.processors, self.config)
+        key = self.cache.key(self.signature, program)
+        fields = self.cache.get(key)
+        if fields is None:
+            # Work on a copy holding only what the processors look at
+            scratch = Program()
+            scratch['title'] = program['title']
+            if 'description' in program:
+                scratch['description'] = program['description']
+            for processor in self.processors:
+                # A processor which empties the title makes it invalid
+                if scratch['title']:
+                    processor.process(scratch)
+            fields = dict(scratch)
+            self.cache.put(key, fields)
+        for (name, value) in fields.iteritems():
+            program[name] = copy.copy(value)
+
 class StripHtml(BaseProcessor):
+    cacheable = True
+
     def process(self, program):
         program['title'] = re.sub('<.*?>', '', program['title'])
 
 class HD(BaseProcessor):
+    cacheable = True
     regex = re.compile(r'HD$')
     
     def process(self, program):
@@ -65,6 +172,7 @@ class HD(BaseProcessor):
             program['description'] = self.regex.sub('', program['description'])
 
 class Widescreen(BaseProcessor):
+    cacheable = True
     regex = re.compile(r' \(WS\)')
     
     def process(self, program):
@@ -76,22 +184,68 @@ class Widescreen(BaseProcessor):
             program['description'] = self.regex.sub('', program['description'])
 
 class Credits(BaseProcessor):
-    actor_regex = re.compile(r'\. Starring: (.*?)\.')
-    director_regex = re.compile(r"Directed by (([A-Za-z'\-]+(\s|.))+)")
-    
+    """
+    Finds actors and the director in the description. Matching is done by
+    scanning rather than with regexes so long descriptions can't make it
+    backtrack.
+    """
+    cacheable = True
+    name_regex = re.compile(r"[A-Za-z'\-]+")
+
+    def actors(self, description):
+        """
+        The text between '. Starring: ' and the next full stop on the same
+        line, as matched by r'\. Starring: (.*?)\.'
+        """
+        start = description.find('. Starring: ')
+        while start != -1:
+            begin = start + 12
+            end = description.find('.', begin)
+            if end == -1:
+                return None
+            if description.find('\n', begin, end) == -1:
+                return description[begin:end]
+            start = description.find('. Starring: ', end)
+        return None
+
+    def director(self, description):
+        """
+        The run of names after 'Directed by ', as matched by
+        r"Directed by (([A-Za-z'\-]+(\s|.))+)". Each name is followed by
+        any one character, except that a name ending the description is
+        taken whole as long as it's two characters or more.
+        """
+        length = len(description)
+        start = description.find('Directed by ')
+        while start != -1:
+            begin = end = start + 12
+            while True:
+                name = self.name_regex.match(description, end)
+                if not name:
+                    break
+                if name.end() < length:
+                    end = name.end() + 1
+                else:
+                    if name.end() - end >= 2:
+                        end = length
+                    break
+            if end > begin:
+                return description[begin:end]
+            start = description.find('Directed by ', start + 1)
+        return None
+
     def process(self, program):
-        matched = self.actor_regex.search(program['description'])
-        if matched:
+        actors = self.actors(program['description'])
+        if actors is not None:
             log.debug("Found actor in program: '%s'", program['title'])
-            program['actors'] = matched.group(1).split(', ')
-            #program['description'] = self.regex.sub('', program['description'])
-        matched = self.director_regex.search(program['description'])
-        if matched:
+            program['actors'] = actors.split(', ')
+        director = self.director(program['description'])
+        if director is not None:
             log.debug("Found director in program: '%s'", program['title'])
-            program['director'] = matched.group(1).strip(' .')
-            #program['description'] = self.regex.sub('', program['description'])
+            program['director'] = director.strip(' .')
 
 class Year(BaseProcessor):
+    cacheable = True
     regex = re.compile(r' \((\d{4})\)\.$')
     
     def process(self, program):
@@ -102,6 +256,7 @@ class Year(BaseProcessor):
             #program['description'] = self.regex.sub('', program['description'])
 
 class MovieTitle(BaseProcessor):
+    cacheable = True
     regex = re.compile(
         r'''(
             Movie|
@@ -124,24 +279,173 @@ class MovieTitle(BaseProcessor):
             program['category_type'] = 'movie'
             program['title'] = self.regex.sub('', program['title'])
 
+class SubtitleScanner(object):
+    """
+    Finds the forms of subtitle Subtitle looks for in a description. Each
+    form has a method to match it at a position and one to yield every
+    match from a position on, as regex.match() and regex.finditer() would
+    with the regexes they replace:
+
+        quoted:       (Today|Tonight)?:? ?'(?P<subtitle>.*?)'\.\s?
+        singleQuoted: '(?P<subtitle>.{2,60}?)'\s
+        colon:        (?P<subtitle>.{2,60}?):\s
+
+    Matches are (start, end, subtitle). The result of each search ahead is
+    remembered, so scanning a description is linear in its length.
+    """
+    # What \s matches without re.UNICODE
+    whitespace = frozenset(' \t\n\r\f\v')
+    closer_regex = re.compile(r"'\s")
+    colon_regex = re.compile(r":\s")
+
+    def __init__(self, description):
+        self.description = description
+        self.length = len(description)
+        self.searches = {}
+
+    def find(self, target, i):
+        """
+        The index of the first occurrence of target, a string or a regex,
+        at or after i or -1. A search starting between the last search for
+        the same target and what it found has the same result, so isn't
+        repeated.
+        """
+        if target in self.searches:
+            (start, found) = self.searches[target]
+            if start <= i and (found == -1 or i <= found):
+                return found
+        if isinstance(target, basestring):
+            found = self.description.find(target, i)
+        else:
+            matched = target.search(self.description, i)
+            if matched:
+                found = matched.start()
+            else:
+                found = -1
+        self.searches[target] = (i, found)
+        return found
+
+    def quotedAt(self, p):
+        description = self.description
+        # The optional parts are tried longest first as the regex would
+        heads = [p]
+        if description.startswith('Today', p):
+            heads.insert(0, p + 5)
+        elif description.startswith('Tonight', p):
+            heads.insert(0, p + 7)
+        for head in heads:
+            colons = [head]
+            if description[head:head + 1] == ':':
+                colons.insert(0, head + 1)
+            for colon in colons:
+                quotes = [colon]
+                if description[colon:colon + 1] == ' ':
+                    quotes.insert(0, colon + 1)
+                for q in quotes:
+                    if description[q:q + 1] != "'":
+                        continue
+                    k = self.find("'.", q + 1)
+                    if k == -1:
+                        continue
+                    n = self.find('\n', q + 1)
+                    if n != -1 and n < k:
+                        continue
+                    end = k + 2
+                    if end < self.length and description[end] in self.whitespace:
+                        end += 1
+                    return (p, end, description[q + 1:k])
+        return None
+
+    def quoted(self, pos):
+        while pos < self.length:
+            quote = self.description.find("'", pos)
+            if quote == -1:
+                return
+            # A match starts at most nine characters before its quote
+            for p in xrange(max(pos, quote - 9), quote + 1):
+                matched = self.quotedAt(p)
+                if matched:
+                    yield matched
+                    pos = matched[1]
+                    break
+            else:
+                pos = quote + 1
+
+    def singleQuotedAt(self, p):
+        if self.description[p:p + 1] != "'":
+            return None
+        c = self.find(self.closer_regex, p + 3)
+        if c == -1 or c > p + 61:
+            return None
+        n = self.find('\n', p + 1)
+        if n != -1 and n < c:
+            return None
+        return (p, c + 2, self.description[p + 1:c])
+
+    def singleQuoted(self, pos):
+        while pos < self.length:
+            p = self.description.find("'", pos)
+            if p == -1:
+                return
+            matched = self.singleQuotedAt(p)
+            if matched:
+                yield matched
+                pos = matched[1]
+            else:
+                pos = p + 1
+
+    def colonAt(self, p):
+        c = self.find(self.colon_regex, p + 2)
+        if c == -1 or c > p + 60:
+            return None
+        n = self.find('\n', p)
+        if n != -1 and n < c:
+            return None
+        return (p, c + 2, self.description[p:c])
+
+    def colon(self, pos):
+        # The earliest start for each colon is the first after pos, 60
+        # characters back and any newline, the first colon which has one
+        # gives the next match
+        c = self.find(self.colon_regex, pos)
+        while c != -1:
+            p = max(pos, c - 60)
+            n = self.description.rfind('\n', p, c)
+            if n != -1:
+                p = n + 1
+            if p <= c - 2:
+                yield (p, c + 2, self.description[p:c])
+                pos = c + 2
+            c = self.find(self.colon_regex, max(c + 1, pos))
+
 class Subtitle(BaseProcessor):
-    regexes = (
-        re.compile(r"(Today|Tonight)?:? ?'(?P<subtitle>.*?)'\.\s?"),
-        re.compile(r"'(?P<subtitle>.{2,60}?)'\s"),
-        re.compile(r"(?P<subtitle>.{2,60}?):\s"),
-    )
+    """
+    Takes a subtitle from the start of the description. Each form is tried
+    in turn on what's left of the description, and when one is found at
+    the start every occurrence of it is removed from the description.
+    """
+    cacheable = True
+    forms = ('quoted', 'singleQuoted', 'colon')
 
     def process(self, program):
         if 'description' in program:
-            for regex in self.regexes:
-                matched = regex.match(program['description'])
+            for form in self.forms:
+                scanner = SubtitleScanner(program['description'])
+                matched = getattr(scanner, form + 'At')(0)
                 if matched:
                     program['category_type'] = 'series'
                     log.debug('Found subtitle in %s', program['description'])
-                    program['subtitle'] = matched.group('subtitle')
-                    program['description'] = regex.sub('', program['description'])
+                    program['subtitle'] = matched[2]
+                    pieces = []
+                    pos = 0
+                    for (start, end, subtitle) in getattr(scanner, form)(0):
+                        pieces.append(scanner.description[pos:start])
+                        pos = end
+                    pieces.append(scanner.description[pos:])
+                    program['description'] = ''.join(pieces)
 
 class MovieDesc(BaseProcessor):
+    cacheable = True
     regex = re.compile(
         r'''(
             Action|
@@ -354,8 +658,20 @@ class CategoryList(BaseProcessor):
                 pass
 
 class CategoryDb(BaseProcessor):
+    # Broadcaster prefixes and suffixes ignored when fuzzy matching,
+    # applied to normalised titles
+    noise_regex = re.compile(r'^(\w+ )?presents |( hd| ws)$')
+    # Number of a title's rarest trigrams used to find candidates
+    fuzzy_trigrams = 8
+    # Trigrams in more titles than this are too common to be useful
+    fuzzy_max_postings = 1000
+    # Number of candidates sharing the most rare trigrams which are scored
+    fuzzy_candidates = 50
+
     def __init__(self, config):
         BaseProcessor.__init__(self, config)
+        self.fuzzy = False
+        self.fuzzy_matches = {}
         try:
             try:
                 # Try sqlite from the standard library (> 2.5)
@@ -373,7 +689,8 @@ class CategoryDb(BaseProcessor):
                 self.valid = False
                 log.info('Not using CategoryDb processor - no config found.')
             else:
-                self.db = sqlite.connect(database)
+                # Processors are set up and used in different threads
+                self.db = sqlite.connect(database, check_same_thread=False)
                 self.c = self.db.cursor()
                 self.c.execute("""CREATE TABLE IF NOT EXISTS categories(
                     id INTEGER PRIMARY KEY,
@@ -382,6 +699,12 @@ class CategoryDb(BaseProcessor):
                     cat VARCHAR
                     )"""
                 )
+                if config.has_option('CategoryDb', 'fuzzy') and config.getboolean('CategoryDb', 'fuzzy'):
+                    self.fuzzy = True
+                    self.fuzzy_threshold = 0.6
+                    if config.has_option('CategoryDb', 'fuzzy_threshold'):
+                        self.fuzzy_threshold = config.getfloat('CategoryDb', 'fuzzy_threshold')
+                    self.buildTrigramIndex()
     
     def process(self, program):
         self.c.execute(
@@ -389,6 +712,8 @@ class CategoryDb(BaseProcessor):
             (program['title'],)
         )
         row = self.c.fetchone()
+        if not row and self.fuzzy:
+            row = self.fuzzyLookup(program['title'])
         if row:
             try:
                 (program['category_type'], program['category_name']) = row
@@ -396,6 +721,157 @@ class CategoryDb(BaseProcessor):
             except Exception, e:
                 log.debug('Exception getting category from DB: %s', e)
 
+    def fuzzyTitle(self, title):
+        return self.noise_regex.sub(u'', normalise_title(title)).strip()
+
+    def trigrams(self, title):
+        title = u'  %s ' % title
+        return set([title[i:i + 3] for i in xrange(len(title) - 2)])
+
+    def buildTrigramIndex(self):
+        """
+        Build the trigram index of category titles used for fuzzy matching,
+        unless it is already up to date with the categories table.
+        """
+        self.c.execute("""CREATE TABLE IF NOT EXISTS category_trigram_info(
+            categories INTEGER,
+            max_id INTEGER
+            )"""
+        )
+        self.c.execute("SELECT COUNT(*), MAX(id) FROM categories")
+        state = self.c.fetchone()
+        self.c.execute("SELECT categories, max_id FROM category_trigram_info")
+        if self.c.fetchone() == state:
+            return
+        log.info('Building CategoryDb trigram index')
+        for table in ('category_trigrams', 'category_trigram_counts', 'category_titles'):
+            self.c.execute("DROP TABLE IF EXISTS %s" % table)
+        self.c.execute("""CREATE TABLE category_titles(
+            id INTEGER PRIMARY KEY,
+            title VARCHAR
+            )"""
+        )
+        self.c.execute("""CREATE TABLE category_trigrams(
+            trigram VARCHAR,
+            id INTEGER
+            )"""
+        )
+        self.c.execute("SELECT id, title FROM categories")
+        titles = [(id, self.fuzzyTitle(title)) for (id, title) in self.c.fetchall() if title]
+        self.c.executemany("INSERT INTO category_titles VALUES (?, ?)", titles)
+        for (id, title) in titles:
+            self.c.executemany("INSERT INTO category_trigrams VALUES (?, ?)",
+                [(trigram, id) for trigram in self.trigrams(title)])
+        self.c.execute("CREATE INDEX category_trigrams_trigram ON category_trigrams(trigram)")
+        self.c.execute("""CREATE TABLE category_trigram_counts AS
+            SELECT trigram, COUNT(*) AS postings FROM category_trigrams GROUP BY trigram"""
+        )
+        self.c.execute("CREATE UNIQUE INDEX category_trigram_counts_trigram ON category_trigram_counts(trigram)")
+        self.c.execute("DELETE FROM category_trigram_info")
+        self.c.execute("INSERT INTO category_trigram_info VALUES (?, ?)", state)
+        self.db.commit()
+
+    def fuzzyLookup(self, title):
+        """
+        Find the category of the most similar title in the trigram index,
+        only the title's rarest trigrams are used to find candidates so the
+        time taken doesn't grow with the size of the database.
+        """
+        if title in self.fuzzy_matches:
+            return self.fuzzy_matches[title]
+        match = None
+        trigrams = self.trigrams(self.fuzzyTitle(title))
+        marks = ','.join(['?'] * len(trigrams))
+        self.c.execute(
+            "SELECT trigram FROM category_trigram_counts WHERE trigram IN (%s) AND postings <= ? "
+            "ORDER BY postings LIMIT ?" % marks,
+            list(trigrams) + [self.fuzzy_max_postings, self.fuzzy_trigrams]
+        )
+        rare = [row[0] for row in self.c.fetchall()]
+        if rare:
+            self.c.execute(
+                "SELECT t.title, c.cat_type, c.cat FROM category_titles t, categories c "
+                "WHERE c.id = t.id AND t.id IN (SELECT id FROM category_trigrams WHERE trigram IN (%s) "
+                "GROUP BY id ORDER BY COUNT(*) DESC LIMIT ?)" % ','.join(['?'] * len(rare)),
+                rare + [self.fuzzy_candidates]
+            )
+            best = self.fuzzy_threshold
+            for (candidate, cat_type, cat) in self.c.fetchall():
+                other = self.trigrams(candidate)
+                score = float(len(trigrams & other)) / len(trigrams | other)
+                if score >= best:
+                    (best, match) = (score, (cat_type, cat))
+            if match:
+                log.debug('Fuzzy matched category %s for %s (similarity %.2f)', match[1], title, best)
+        self.fuzzy_matches[title] = match
+        return match
+
+class Imdb(BaseProcessor):
+    def __init__(self, config):
+        BaseProcessor.__init__(self, config)
+        self.lookups = {}
+        try:
+            database = os.path.expanduser(config.get('Imdb', 'database'))
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            self.valid = False
+            log.info('Not using Imdb processor - no config found.')
+        else:
+            if not os.path.isfile(database):
+                self.valid = False
+                log.info('Not using Imdb processor - %s not found, create it with epgsnoop-imdb-index.', database)
+            else:
+                try:
+                    self.db = imdb.connect(database)
+                except ImportError:
+                    self.valid = False
+                    log.info('Not using Imdb processor - sqlite not found.')
+
+    def process(self, program):
+        try:
+            year = int(program.get('year'))
+        except (TypeError, ValueError):
+            year = None
+        match = self.lookup(program['title'], year, program.get('category_type') == 'movie')
+        if match:
+            (imdb_id, runtime, rating) = match
+            log.debug('Found IMDb id %s for %s', imdb_id, program['title'])
+            program['imdb_id'] = imdb_id
+            if runtime:
+                program['runtime'] = runtime
+            if rating:
+                program['star_rating'] = rating
+
+    def lookup(self, title, year=None, movie=False):
+        """
+        Return the IMDb id, runtime and rating for a title. Titles with a
+        year match the closest year within one either way, without a year
+        only movie titles with a single match are used.
+        """
+        key = (title, year, movie)
+        try:
+            return self.lookups[key]
+        except KeyError:
+            pass
+        match = None
+        title = normalise_title(title)
+        if year:
+            rows = self.db.execute(
+                "SELECT imdb_id, runtime, rating, year, votes FROM titles WHERE title = ? AND year BETWEEN ? AND ?",
+                (title, year - 1, year + 1)
+            ).fetchall()
+            if rows:
+                rows.sort(key=lambda row: (abs(row[3] - year), -(row[4] or 0)))
+                match = rows[0][:3]
+        elif movie:
+            rows = self.db.execute(
+                "SELECT imdb_id, runtime, rating FROM titles WHERE title = ? AND title_type IN ('movie', 'tvMovie')",
+                (title,)
+            ).fetchall()
+            if len(rows) == 1:
+                match = rows[0]
+        self.lookups[key] = match
+        return match
+
 class SkyRatings(BaseProcessor):
     RATING_SYSTEM = 'SKY-NZ'
     RATINGS = {
@@ -464,14 +940,21 @@ class SearchReplaceTitle(BaseProcessor):
                 log.debug('SearchReplaceTitle: Changed title from "%s" to "%s"', program['title'], r['replace'])
 
 class BBCWorldOnTV1(BaseProcessor):
-    programs_to_delete = []
-    programs_to_insert = []
+    per_program = False
+
+    def __init__(self, config):
+        BaseProcessor.__init__(self, config)
+        self.programs_to_delete = []
+        self.programs_to_insert = []
+        self.timeline = None
 
     def process(self, program):
         if program['channel'].xmltvid == 'tv1.sky.co.nz' and re.match(r'BBC World( \d{4})?', program['title']):
-            for op in self.programs:
-                if op.isValid() and op['channel'].xmltvid == 'bbc-world.sky.co.nz'\
-                and op['start'] > program['start'] and op['end'] < program['end']:
+            if self.timeline is None:
+                self.timeline = Timeline(self.programs)
+            bbc_world = self.timeline.pid('bbc-world.sky.co.nz')
+            for op in self.timeline.between(bbc_world, program['start'], program['end']):
+                if op['start'] > program['start'] and op['end'] < program['end']:
                     np = copy.deepcopy(op)
                     np['channel'] = program['channel']
                     self.programs_to_insert.append(np)
@@ -484,4 +967,7 @@ class BBCWorldOnTV1(BaseProcessor):
         for program in self.programs_to_insert:
             log.debug('Inserting program %s', program)
             self.programs.append(program)
+        self.programs_to_delete = []
+        self.programs_to_insert = []
+        self.timeline = None
 
@@ -0,0 +1,111 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import os
+import time
+import errno
+import threading
+from collections import deque
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+class ReadTimeout(Exception):
+    pass
+
+class RingBuffer(threading.Thread):
+    """
+    Drains a pipe into a bounded buffer from a thread of its own, so the
+    process writing to the pipe isn't held up while lines are parsed.
+
+    The pipe is read in blocks of up to `block_size` bytes, and reading
+    stops once `max_bytes` are buffered however small the blocks the pipe
+    gives. When the buffer is full the reader waits for the parser, which
+    is counted in `overflows`. Each time the parser has to wait for data is
+    counted in `waits`.
+    """
+    def __init__(self, f, max_bytes=16 * 1024 * 1024, block_size=65536):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fd = f.fileno()
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.blocks = deque()
+        self.buffered = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        self.lines = deque()
+        self.pending = ''
+        self.overflows = 0
+        self.waits = 0
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.fd, self.block_size)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                data = ''
+            self.condition.acquire()
+            try:
+                if not data:
+                    self.closed = True
+                    self.condition.notifyAll()
+                    return
+                if self.buffered >= self.max_bytes:
+                    self.overflows += 1
+                    while self.buffered >= self.max_bytes:
+                        self.condition.wait()
+                self.blocks.append(data)
+                self.buffered += len(data)
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+    def nextBlock(self, timeout=None):
+        """
+        Wait for the next block, returns '' once the pipe is closed and
+        everything read from it has been consumed. Raises ReadTimeout if
+        nothing arrives within timeout seconds.
+        """
+        self.condition.acquire()
+        try:
+            if not self.blocks and not self.closed:
+                self.waits += 1
+                if timeout is not None:
+                    expires = time.time() + timeout
+                while not self.blocks and not self.closed:
+                    if timeout is None:
+                        self.condition.wait()
+                        continue
+                    remaining = expires - time.time()
+                    if remaining <= 0:
+                        raise ReadTimeout('No data read for %s seconds' % timeout)
+                    self.condition.wait(remaining)
+            if not self.blocks:
+                return ''
+            data = self.blocks.popleft()
+            self.buffered -= len(data)
+            self.condition.notifyAll()
+            return data
+        finally:
+            self.condition.release()
+
+    def readline(self, timeout=None):
+        """
+        Return the next line including its newline, or '' at end of file,
+        like file.readline(). Raises ReadTimeout if a line doesn't arrive
+        within timeout seconds.
+        """
+        while not self.lines:
+            data = self.nextBlock(timeout)
+            if not data:
+                line = self.pending
+                self.pending = ''
+                return line
+            lines = (self.pending + data).split('\n')
+            self.pending = lines.pop()
+            self.lines.extend([line + '\n' for line in lines])
+        return self.lines.popleft()
@@ -3,19 +3,27 @@
 
 import os
 import sys
+import time
 import subprocess
 import signal
 import re
+from functools import partial
 
 from base import *
+from ringbuffer import RingBuffer, ReadTimeout
+
+log = logging.getLogger(NAME)
+
+# Lines which give a section its structure, the other fields are read by
+# Snooper methods
+SERVICE = object()
+EVENT = object()
+END = object()
 
 class Snooper(object):
     # regex's for packet data extraction
     decode_regex = re.compile(r'\[= (.*?)\]$')
     detail_regex = re.compile(r'[char|name]: "(.*?)"  -- Charset')
-    
-    programs = []
-    unique = {}
 
     # Maximum number of packets with no data before we stop
     nilpkts = 2500
@@ -23,108 +31,245 @@ class Snooper(object):
     # Key counters
     events = 0
     packets = 0
+    repeats = 0
+
+    # Event fields, by the name before the colon, which are the first word
+    # of the value and optionally the [= ...] description of it
+    token_fields = {
+        'Start_time': ('start', 'startinfo'),
+        'Duration': ('duration', 'durationinfo'),
+        'Rating': ('ratingnum', 'ratinginfo'),
+        'Content_nibble_level_1': ('content_1', None),
+        'Content_nibble_level_2': ('content_2', None),
+        'User_nibble_1': ('user_1', None),
+        'User_nibble_2': ('user_2', None),
+    }
+    # Event fields which are the whole value
+    text_fields = {
+        'Country_code': 'country',
+    }
+    # Event fields which are a quoted string
+    detail_fields = {
+        'event_name': 'title',
+        'text_char': 'description',
+    }
+
+    # Section header fields which with the CRC identify a section
+    section_fields = ('Table_ID', 'Service_ID', 'Transport_Stream_ID', 'Original_Network_ID',
+        'Version_number', 'Section_number')
+    # dvbsnoop isn't consistent in its capitalisation of these, e.g.
+    # Original_network_ID, so they're matched by their lower case labels
+    section_labels = dict([(field.lower(), field) for field in section_fields])
 
-    def __init__(self, adapter, quiet=False):
+    def __init__(self, adapter, quiet=False, programs=None, deadline=None, idle_timeout=None,
+            now_next=False, services=None):
         self.quiet = quiet
         self.adapter = adapter
+        # Only capture the present/following tables, finishing once both
+        # sections have been seen for each of services
+        self.now_next = now_next
+        self.services = services
+        self.present_following = {}
+        # Seconds to capture for at most, and to wait for dvbsnoop to
+        # output something before giving up on it
+        self.deadline = deadline
+        self.idle_timeout = idle_timeout
+        # Anything with an append method, e.g. a ProgramSpool
+        if programs is None:
+            programs = []
+        self.programs = programs
+        self.sections = set()
+        # (original_network_id, transport_stream_id, service_id, event_id)
+        # -> (table_id, version, position) of the copy of each event kept
+        # in programs
+        self.unique = {}
+        # service_id -> {(original_network_id, transport_stream_id, other):
+        # events} for the transports each service's schedule came from
+        self.schedules = {}
+        # Field name -> handler, None for fields which aren't wanted
+        self.fields = {'Service_ID': SERVICE, 'Event_ID': EVENT, 'CRC': END}
+        for (field, (key, info)) in self.token_fields.items():
+            self.fields[field] = partial(self.tokenField, key, info)
+        for (field, key) in self.text_fields.items():
+            self.fields[field] = partial(self.textField, key)
+        for (field, key) in self.detail_fields.items():
+            self.fields[field] = partial(self.detailField, key)
+
+    def sectionHeader(self, pkt):
+        """
+        Read the table, service, version and section number of a section
+        and its CRC, reading only the section header and the last line.
+        """
+        header = {}
+        for data in pkt:
+            if data[:8] == "Event_ID":
+                break
+            field = self.section_labels.get(data.split(':', 1)[0].lower())
+            if field:
+                header[field] = int(data.split(': ')[1].split()[0])
+        if pkt[-1][:3] == "CRC":
+            header['CRC'] = int(pkt[-1].split(': ')[1].split()[0])
+        return header
+
+    def sectionKey(self, header):
+        """
+        Identify a section by its header and CRC.
+        """
+        return tuple([header.get(field) for field in self.section_fields + ('CRC',)])
 
-    def processPacket(self, pkt):
+    def storeEvent(self, key, header, event):
+        """
+        Keep the first copy of an event, or a copy from a newer version of
+        the same table, in place of the one kept before. Returns True if
+        the event was kept.
+        """
+        table = header.get('Table_ID')
+        version = header.get('Version_number')
+        stored = self.unique.get(key)
+        if stored is None:
+            self.unique[key] = (table, version, len(self.programs))
+            self.programs.append(event)
+            return True
+        # Version numbers are per table and wrap at 32
+        if stored[0] == table and version is not None and 0 < (version - stored[1]) % 32 < 16:
+            log.debug('Replacing %s with version %s', event, version)
+            self.unique[key] = (table, version, stored[2])
+            self.programs[stored[2]] = event
+            return True
+        return False
+
+    def processPacket(self, pkt, header=None):
         found = 0
+        if header is None:
+            header = self.sectionHeader(pkt)
 
         # Process the packet
         self.packets += 1
-        event_id = None
+        fields = self.fields
+        channel = event = None
+        # Events are identified within their transport, which for the
+        # other transport tables (0x4f, 0x60-0x6f) isn't the one tuned
+        onid = header.get('Original_Network_ID')
+        tsid = header.get('Transport_Stream_ID')
         for data in pkt:
+            # Each line is handled according to the name before its colon
+            colon = data.find(':')
+            if colon == -1:
+                field = data
+            else:
+                field = data[:colon]
+            try:
+                handler = fields[field]
+            except KeyError:
+                handler = self.fieldHandler(field)
+            if handler is None:
+                continue
+
             # Channel ID for this packet
-            if data[:10] == "Service_ID":
-                channel = data.split(': ')[1:][0].split()[0]
+            if handler is SERVICE:
+                channel = data[colon + 2:].split()[0]
+                continue
 
             # Are we in en event
-            if data[:8] == "Event_ID":
+            if handler is EVENT:
                 # Store old event and create a new one
-                if event_id:
-                    key = channel + "|" + event_id
-                    if not self.unique.has_key(key):
+                if event is not None:
+                    if self.storeEvent((onid, tsid, int(channel), event['event_id']), header, event):
                         found += 1
-                        self.unique[key] = True
-                        self.programs.append(event)
-                event_id = data.split(': ')[1:][0].split()[0]
                 event = Program()
                 event['pid'] = channel
+                event['event_id'] = int(data[colon + 2:].split()[0])
                 self.events += 1
                 continue
 
             # End of packet store last event
-            if data[:3] == "CRC":
-                if event_id:
-                    key = channel + "|" + event_id
-                    if not self.unique.has_key(key):
+            if handler is END:
+                if event is not None:
+                    if self.storeEvent((onid, tsid, int(channel), event['event_id']), header, event):
                         found += 1
-                        self.unique[key] = True
-                        self.programs.append(event)
-
-            # Check for event data
-            if event_id:
-                # Starttime
-                if data[:11] == "Start_time:":
-                    event['start'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    event['startinfo'] = self.decode_regex.findall(data)[0].strip()
-                    continue
-                # Duration
-                if data[:9] == "Duration:":
-                    event['duration'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    event['durationinfo'] = self.decode_regex.findall(data)[0].strip()
-                    continue
-                # Name
-                if data[:11] == "event_name:":
-                    try:
-                        event['title'] = self.detail_regex.findall(data)[0].decode('latin-1')
-                    except IndexError:
-                        event['title'] = ""
-                    continue
-                # Description
-                if data[:10] == "text_char:":
-                    try:
-                        event['description'] = self.detail_regex.findall(data)[0].decode('latin-1')
-                    except:
-                        event['description'] = ""
-                    continue
-                # Rating
-                if data[:7] == "Rating:":
-                    event['ratingnum'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    event['ratinginfo'] = self.decode_regex.findall(data)[0].strip()
-                    continue
-                # Country
-                if data[:13] == "Country_code:":
-                    event['country'] = ' '.join(data.split(': ')[1:]).strip()
-                    continue
-                # Language
-                if data.find("language_code:") >= 0:
-                    event['language'] = ' '.join(data.split(': ')[1:]).strip()
-                    continue
-                # Content
-                if data[:23] == "Content_nibble_level_1:":
-                    event['content_1'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    continue
-                if data[:23] == "Content_nibble_level_2:":
-                    event['content_2'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    continue
-                if data[:3] == "[= ":
-                    event['contentinfo'] = self.decode_regex.findall(data)[0].strip()
-                    continue
-                # User
-                if data[:14] == "User_nibble_1:":
-                    event['user_1'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    continue
-                if data[:14] == "User_nibble_2:":
-                    event['user_2'] = ' '.join(data.split(': ')[1:]).split()[0]
-                    continue
+                    event = None
+                continue
+
+            # Event data
+            if event is not None:
+                handler(event, data, colon)
+
+        # Note where schedules come from
+        table = header.get('Table_ID')
+        if found and table is not None and 0x50 <= table <= 0x6f:
+            transports = self.schedules.setdefault(header.get('Service_ID'), {})
+            transport = (onid, tsid, table >= 0x60)
+            transports[transport] = transports.get(transport, 0) + found
+
         # Found how many shows?
         return found
 
+    def reportTransports(self):
+        """
+        Log which transport each service's schedule came from.
+        """
+        other = 0
+        transports = set()
+        for service in sorted(self.schedules):
+            for ((onid, tsid, is_other), events) in sorted(self.schedules[service].items()):
+                transports.add((onid, tsid))
+                if is_other:
+                    other += 1
+                    source = 'other transport tables'
+                else:
+                    source = 'actual transport tables'
+                log.debug('Service %s: %s events from transport %s on network %s (%s)',
+                    service, events, tsid, onid, source)
+        log.info('Schedules for %s services from %s transports, %s from other transport tables',
+            len(self.schedules), len(transports), other)
+
+    def fieldHandler(self, field):
+        """
+        Find the handler for a field which isn't one of the event fields,
+        remembering it for the next line with the same name.
+        """
+        if field.endswith('language_code'):
+            handler = partial(self.textField, 'language')
+        elif field[:3] == '[= ':
+            handler = self.contentInfo
+        else:
+            handler = None
+        # Descriptions without a colon are names too, don't let odd data
+        # grow the table without limit
+        if len(self.fields) < 1000:
+            self.fields[field] = handler
+        return handler
+
+    def tokenField(self, key, info, event, data, colon):
+        """
+        The first word of the value, and the [= ...] description as info.
+        """
+        value = data[colon + 2:].split(None, 1)[0]
+        if value[-1:] == ':':
+            # A colon and space within the value separate words too
+            value = data[colon + 2:].replace(': ', ' ').split()[0]
+        event[key] = value
+        if info:
+            event[info] = self.decode_regex.findall(data)[0].strip()
+
+    def textField(self, key, event, data, colon):
+        event[key] = data[colon + 2:].replace(': ', ' ').strip()
+
+    def detailField(self, key, event, data, colon):
+        try:
+            event[key] = self.detail_regex.findall(data)[0].decode('latin-1')
+        except IndexError:
+            event[key] = ""
+
+    def contentInfo(self, event, data, colon):
+        event['contentinfo'] = self.decode_regex.findall(data)[0].strip()
+
     def snoop(self):
         # Open stream
         command = ('dvbsnoop', '-adapter', self.adapter, '-nph', '0x12')
+        if self.now_next:
+            # Table ids 0x4e and 0x4f
+            command += ('-f', '0x4e', '-m', '0xfe')
 
         self.snoop = subprocess.Popen(
             command,
@@ -134,6 +279,22 @@ class Snooper(object):
 
         self.snoop.stderr.close()
 
+        # Read the pipe from a thread of its own so dvbsnoop isn't kept
+        # waiting while packets are parsed
+        self.reader = RingBuffer(self.snoop.stdout)
+        self.reader.start()
+
+        deadline = None
+        if self.deadline:
+            deadline = time.time() + self.deadline
+        def readline():
+            timeout = self.idle_timeout
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+                if timeout is None or remaining < timeout:
+                    timeout = remaining
+            return self.reader.readline(timeout)
+
         # Loop packets
         check = i = 0
         if not self.quiet:
@@ -144,33 +305,89 @@ class Snooper(object):
             if not self.quiet:
                 s.out('Processing packets: %05d' % i)
         
-            # Get packet start
-            out = self.snoop.stdout.readline()
-            while out and out[:11] != "SECT-Packet":
-                out = self.snoop.stdout.readline()
-        
-            # Packetize
-            pkt = []
-            pkt.append(out.strip())
-            while out and out[:3] != "CRC":
-                out = self.snoop.stdout.readline()
+            try:
+                # Get packet start
+                out = readline()
+                while out and out[:11] != "SECT-Packet":
+                    out = readline()
+
+                # Packetize
+                pkt = []
                 pkt.append(out.strip())
-        
-            # Process the packet
-            found = self.processPacket(pkt)
+                while out and out[:3] != "CRC":
+                    out = readline()
+                    pkt.append(out.strip())
+            except ReadTimeout:
+                if deadline is not None and time.time() >= deadline:
+                    log.warning('Capture deadline of %s seconds reached, stopping.', self.deadline)
+                else:
+                    log.warning('No data from dvbsnoop for %s seconds, stopping.', self.idle_timeout)
+                break
+
+            # Process the packet, unless it's a repeat of one we've seen
+            header = self.sectionHeader(pkt)
+            key = self.sectionKey(header)
+            if key in self.sections:
+                self.repeats += 1
+                found = 0
+            else:
+                self.sections.add(key)
+                found = self.processPacket(pkt, header)
             if found > 0:
                 check = 0
             else:
                 check += 1
+
+            if self.now_next and self.nowNextComplete(header):
+                log.info('Present and following events found for all services.')
+                break
         
             # Had enoungh
             if check >= self.nilpkts:
                 break
+
+            if deadline is not None and time.time() >= deadline:
+                log.warning('Capture deadline of %s seconds reached, stopping.', self.deadline)
+                break
         
-        # Natural completion ... kill snoop
+        # Natural completion, or out of time ... kill snoop
         self.kill()
+        self.reportTransports()
+        log.debug('Skipped %s repeated sections', self.repeats)
+        log.debug('Read buffer: parser waited %s times, buffer filled %s times',
+            self.reader.waits, self.reader.overflows)
+        if self.reader.overflows:
+            log.info('Parsing fell behind, the read buffer filled %s times', self.reader.overflows)
         return self.programs
 
-    def kill(self):
+    def nowNextComplete(self, header):
+        """
+        Record a present/following section, returns True once both
+        sections have been seen for every service.
+        """
+        if header.get('Table_ID') not in (0x4e, 0x4f) or 'Service_ID' not in header:
+            return False
+        sections = self.present_following.setdefault(str(header['Service_ID']), set())
+        sections.add(header.get('Section_number'))
+        for service in self.services or self.present_following:
+            if not set((0, 1)) <= self.present_following.get(service, set()):
+                return False
+        return True
+
+    def kill(self, wait=2):
+        """
+        Terminate dvbsnoop, killing it outright if it hasn't exited after
+        wait seconds.
+        """
+        if self.snoop.poll() is not None:
+            return
         os.kill(self.snoop.pid, signal.SIGTERM)
+        expires = time.time() + wait
+        while self.snoop.poll() is None:
+            if time.time() >= expires:
+                log.warning('dvbsnoop did not exit, killing it.')
+                os.kill(self.snoop.pid, signal.SIGKILL)
+                self.snoop.wait()
+                break
+            time.sleep(0.05)
 
@@ -0,0 +1,137 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import os
+import tempfile
+import cPickle as pickle
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+def modify(programs):
+    """
+    Iterate over programs for the purpose of changing them. Changes made
+    to programs from a ProgramSpool are only kept when iterating this way.
+    """
+    if isinstance(programs, ProgramSpool):
+        return programs.modify()
+    return iter(programs)
+
+class ProgramSpool(object):
+    """
+    A list-like store of programs which keeps at most `threshold` programs
+    in memory and spills the rest to a temporary file.
+
+    Programs are always returned in the order they were appended so the
+    results of iterating a spool are the same as iterating a list. Spilled
+    programs are read back from disk `batch_size` at a time.
+    """
+
+    def __init__(self, threshold, batch_size=500, directory=None):
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.directory = directory
+        self.memory = []
+        self.offsets = []
+        self.file = None
+
+    def __len__(self):
+        return len(self.memory) + len(self.offsets)
+
+    def __iter__(self):
+        for program in self.memory:
+            yield program
+        for batch in self.batches():
+            for program in batch:
+                yield program
+
+    def __getitem__(self, i):
+        if i < len(self.memory):
+            return self.memory[i]
+        self.file.seek(self.offsets[i - len(self.memory)])
+        return pickle.load(self.file)
+
+    def __setitem__(self, i, program):
+        if i < len(self.memory):
+            self.memory[i] = program
+        else:
+            self.offsets[i - len(self.memory)] = self._write(self.file, program)
+
+    def append(self, program):
+        # Once spilling starts everything goes to disk to keep the order
+        if self.file is None and len(self.memory) < self.threshold:
+            self.memory.append(program)
+        else:
+            if self.file is None:
+                log.debug('Spilling programs to disk after %s programs', self.threshold)
+                self.file = self._open()
+            self.offsets.append(self._write(self.file, program))
+
+    def remove(self, program):
+        if program in self.memory:
+            self.memory.remove(program)
+            return
+        new_file = self._open()
+        new_offsets = []
+        removed = False
+        for batch in self.batches():
+            for p in batch:
+                if not removed and p == program:
+                    removed = True
+                else:
+                    new_offsets.append(self._write(new_file, p))
+        if not removed:
+            new_file.close()
+            raise ValueError('ProgramSpool.remove(x): x not in spool')
+        self._replace(new_file, new_offsets)
+
+    def batches(self):
+        """
+        Yield lists of at most `batch_size` programs read back from disk.
+        """
+        for i in xrange(0, len(self.offsets), self.batch_size):
+            batch = []
+            for offset in self.offsets[i:i + self.batch_size]:
+                self.file.seek(offset)
+                batch.append(pickle.load(self.file))
+            yield batch
+
+    def modify(self):
+        """
+        Iterate over all programs, writing changes made to spilled programs
+        back to disk. The changes are only stored once iteration finishes.
+        """
+        for program in self.memory:
+            yield program
+        if not self.offsets:
+            return
+        new_file = self._open()
+        new_offsets = []
+        for batch in self.batches():
+            for program in batch:
+                yield program
+            for program in batch:
+                new_offsets.append(self._write(new_file, program))
+        self._replace(new_file, new_offsets)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.memory = []
+        self.offsets = []
+
+    def _open(self):
+        return tempfile.TemporaryFile(prefix='%s-' % NAME, dir=self.directory)
+
+    def _write(self, f, program):
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        pickle.dump(program, f, pickle.HIGHEST_PROTOCOL)
+        return offset
+
+    def _replace(self, new_file, new_offsets):
+        self.file.close()
+        self.file = new_file
+        self.offsets = new_offsets
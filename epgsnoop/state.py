@@ -0,0 +1,89 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+import os
+import tempfile
+import cPickle as pickle
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+def save_programs(path, programs):
+    """
+    Save a snapshot of the valid programs to path, replacing any earlier
+    snapshot only once the new one is complete.
+    """
+    (directory, name) = os.path.split(os.path.abspath(path))
+    (fd, tmp) = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+    f = os.fdopen(fd, 'wb')
+    try:
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        count = 0
+        for program in programs:
+            if program.isValid():
+                pickler.dump(program)
+                # Programs are independent, don't keep them all in the memo
+                pickler.clear_memo()
+                count += 1
+        f.close()
+        os.rename(tmp, path)
+    except:
+        f.close()
+        os.remove(tmp)
+        raise
+    log.debug('Saved %s programs to %s', count, path)
+    return count
+
+def iter_programs(path, channels):
+    """
+    Yield the programs saved at path one at a time, each given its channel
+    from channels. Programs on channels which are no longer configured are
+    left out. Yields nothing if there is no snapshot.
+    """
+    if not os.path.exists(path):
+        return
+    f = open(path, 'rb')
+    try:
+        unpickler = pickle.Unpickler(f)
+        while True:
+            try:
+                program = unpickler.load()
+            except EOFError:
+                break
+            if program['pid'] in channels:
+                program['channel'] = channels[program['pid']]
+                yield program
+    finally:
+        f.close()
+
+def load_programs(path, channels):
+    """
+    Load the programs saved at path as a list, see iter_programs().
+    """
+    programs = list(iter_programs(path, channels))
+    log.debug('Loaded %s programs from %s', len(programs), path)
+    return programs
+
+def merge_now_next(guide, updates):
+    """
+    Merge present/following programs into a guide. For each channel in
+    updates, programs in the guide which overlap the updated period are
+    replaced by the updates.
+    """
+    updates = [program for program in updates if program.isValid()]
+    periods = {}
+    for program in updates:
+        pid = program['channel'].pid
+        (start, end) = periods.get(pid, (program['start'], program['end']))
+        periods[pid] = (min(start, program['start']), max(end, program['end']))
+    merged = []
+    for program in guide:
+        period = periods.get(program['channel'].pid)
+        if period and program['start'] < period[1] and program['end'] > period[0]:
+            continue
+        merged.append(program)
+    log.info('Replaced %s programs in the last guide with %s present/following programs',
+        len(guide) - len(merged), len(updates))
+    merged.extend(updates)
+    return merged
@@ -0,0 +1,98 @@
+# By hads <hads@nice.net.nz>
+# Released under the MIT license
+
+from bisect import bisect_left
+
+from base import *
+
+log = logging.getLogger(NAME)
+
+def channel_order(channel):
+    """
+    Sort key used to emit channels in a consistent order.
+    """
+    return (channel.xmltvid or '', channel.pid)
+
+class Timeline(object):
+    """
+    An index of valid programs by channel, sorted by start time.
+
+    Iterating a timeline gives the programs a channel at a time, in
+    channel_order(), with each channel's programs in start time order. The
+    programs themselves stay in `programs`, which can be a list or a
+    ProgramSpool, and are looked up by position.
+    """
+    def __init__(self, programs):
+        self.programs = programs
+        self.entries = {}
+        self.channels = {}
+        position = 0
+        for program in programs:
+            if program.isValid():
+                channel = program['channel']
+                self.channels[channel.pid] = channel
+                self.entries.setdefault(channel.pid, []).append((program['start'], position))
+            position += 1
+        for entries in self.entries.values():
+            entries.sort()
+        self.xmltvids = dict([(c.xmltvid, c.pid) for c in self.channels.values()])
+
+    def __len__(self):
+        return sum([len(entries) for entries in self.entries.values()])
+
+    def __iter__(self):
+        for channel in sorted(self.channels.values(), key=channel_order):
+            for program in self.channel(channel.pid):
+                yield program
+
+    def channel(self, pid):
+        """
+        Yield the programs for the channel with pid in start time order.
+        """
+        for (start, position) in self.entries.get(pid, []):
+            yield self.programs[position]
+
+    def between(self, pid, start, end):
+        """
+        Yield the programs for the channel with pid which start at or
+        after start and before end.
+        """
+        entries = self.entries.get(pid, [])
+        i = bisect_left(entries, (start,))
+        while i < len(entries) and entries[i][0] < end:
+            yield self.programs[entries[i][1]]
+            i += 1
+
+    def pid(self, xmltvid):
+        return self.xmltvids.get(xmltvid)
+
+    def resolveOverlaps(self):
+        """
+        Remove programs which start at the same time as an earlier captured
+        program on the same channel and cut short any program which runs
+        into the next one. Returns the number of programs changed or removed.
+        """
+        changes = 0
+        for (pid, entries) in self.entries.items():
+            # Entries sort by position after start so the first captured
+            # of programs starting together is kept
+            kept = []
+            previous = None
+            for (start, position) in entries:
+                if kept and kept[-1][0] == start:
+                    log.debug('Removing duplicate program %s', self.programs[position])
+                    changes += 1
+                    continue
+                if kept:
+                    if previous['end'] > start:
+                        log.debug('Ending %s at the start of the next program', previous)
+                        previous['end'] = start
+                        previous['duration'] = start - previous['start']
+                        self.programs[kept[-1][1]] = previous
+                        changes += 1
+                kept.append((start, position))
+                previous = self.programs[position]
+            entries[:] = kept
+        if changes:
+            log.info('Resolved %s overlapping programs', changes)
+        return changes
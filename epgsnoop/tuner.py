@@ -3,6 +3,7 @@
 
 import os
 import signal
+import threading
 import subprocess
 from time import sleep
 
@@ -12,9 +13,11 @@ class TuningFailed(Exception):
     pass
 
 class Tuner(object):
-    def __init__(self, adapter, lnb_offset):
+    def __init__(self, adapter, lnb_offset, flush_timeout=None):
         self.adapter = adapter
         self.lnb_offset = int(lnb_offset)
+        # Seconds to let the flush run before killing it
+        self.flush_timeout = flush_timeout
 
     def tune(self, frequency, polarity, symbol_rate, flush=True):
         log.info('Tuning DVB card %s', self.adapter)
@@ -37,6 +40,10 @@ class Tuner(object):
         # self.tuner.kill() was only introduced in 2.6
         os.kill(self.tuner.pid, signal.SIGTERM)
 
+    def killFlush(self):
+        if self.dvbsnoop_flush.poll() is None:
+            os.kill(self.dvbsnoop_flush.pid, signal.SIGKILL)
+
     def flush(self):
         """
         It seems that dvbsnoop can output data buffered from the previous tune.
@@ -48,6 +55,15 @@ class Tuner(object):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE
         )
+        timer = None
+        if self.flush_timeout:
+            timer = threading.Timer(self.flush_timeout, self.killFlush)
+            timer.start()
         (stdoutdata, stderrdata) = self.dvbsnoop_flush.communicate()
-        log.info('Done.')
+        if timer:
+            timer.cancel()
+        if self.dvbsnoop_flush.returncode == -signal.SIGKILL:
+            log.warning('Flushing took more than %s seconds, continuing anyway.', self.flush_timeout)
+        else:
+            log.info('Done.')
 
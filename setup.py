@@ -23,7 +23,7 @@ setup(
     url='http://launchpad.net/epgsnoop',
     download_url='http://launchpad.net/epgsnoop',
     packages=['epgsnoop'],
-    scripts=['scripts/epgsnoop'],
+    scripts=['scripts/epgsnoop', 'scripts/epgsnoop-imdb-index', 'scripts/epgsnoop-merge'],
     license='MIT',
     platforms='Linux',
     classifiers=[